@@ -9,17 +9,54 @@ import hashlib
 import hmac
 import json
 import time
+import uuid
 from datetime import datetime
+from functools import partial
+from typing import BinaryIO, Dict, Optional
 from urllib.parse import quote_plus, urljoin
 
 import click
 import requests
 from pygments import highlight, lexers, formatters
 
+from .multipart import MultipartBody
+from .profiling import Profile
+from .scheduler import AdaptiveScheduler, TokenBucket, TransferError, part_size_for
+from .watch import DirectoryWatcher, ManifestWriter, SharePool, pooled_session
+
 
 ONCE_CONFIG_FILE = os.getenv("ONCE_CONFIG_FILE", os.path.expanduser("~/.once"))
 ONCE_SIGNATURE_HEADER = "x-once-signature"
+ONCE_IDEMPOTENCY_HEADER = "x-once-idempotency-key"
+ONCE_API_TIMEOUT = 35
+ONCE_TICKET_RETRIES = 3
+ONCE_TICKET_RETRY_BACKOFF = 0.5
+ONCE_RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
 ONCE_TIMESTAMP_FORMAT = "%Y%m%d%H%M%S%f"
+ONCE_HASH_CHUNK_SIZE = 1024 * 1024
+ONCE_DEFAULT_INLINE_THRESHOLD = "1M"
+ONCE_DEFAULT_MULTIPART_THRESHOLD = "32M"
+ONCE_DEFAULT_CHUNK_SIZE = "8M"
+ONCE_DEFAULT_MAX_STREAMS = 8
+ONCE_DEFAULT_HASH_MAX_SIZE = "512M"
+ONCE_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+class UploadError(Exception):
+    """The file could not be shared"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Tells whether a share failed with a transient error, which may not occur again
+    """
+    if isinstance(error, UploadError):
+        return error.status_code is None or error.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
 
 
 def highlight_json(obj):
@@ -31,16 +68,70 @@ def echo_obj(obj):
     click.echo(highlight_json(obj))
 
 
+def content_hash(file) -> str:
+    """
+    Returns the hex encoded SHA-256 digest of a binary file,
+    rewinding it to the initial position
+    """
+    hash_obj = hashlib.sha256()
+    for chunk in iter(lambda: file.read(ONCE_HASH_CHUNK_SIZE), b""):
+        hash_obj.update(chunk)
+    file.seek(0)
+    return hash_obj.hexdigest()
+
+
 def get_config(config_file: str = ONCE_CONFIG_FILE) -> configparser.ConfigParser:
     if not os.path.exists(config_file):
         raise ValueError(f"Config file not found at {config_file}")
     config = configparser.ConfigParser()
-    config.read(ONCE_CONFIG_FILE)
+    config.read(config_file)
     return config
 
 
-def api_req(method: str, url: str, verbose: bool = False, **kwargs):
-    config = get_config()
+def parse_size(value: str) -> int:
+    """
+    Parses a size in bytes, optionally followed by a K, M or G binary unit (e.g. `8M`)
+    """
+    value = str(value).strip().upper()
+    unit = value[-1:] if value[-1:] in ONCE_SIZE_UNITS else ""
+    try:
+        return int(float(value[: len(value) - len(unit)]) * ONCE_SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError(f'Invalid size "{value}"')
+
+
+def get_transfer_settings(config: configparser.ConfigParser) -> Dict:
+    """
+    Reads the upload settings from the `once` section of the configuration
+    """
+    return {
+        "inline_threshold": parse_size(config.get("once", "inline_threshold", fallback=ONCE_DEFAULT_INLINE_THRESHOLD)),
+        "multipart_threshold": parse_size(
+            config.get("once", "multipart_threshold", fallback=ONCE_DEFAULT_MULTIPART_THRESHOLD)
+        ),
+        "chunk_size": parse_size(config.get("once", "chunk_size", fallback=ONCE_DEFAULT_CHUNK_SIZE)),
+        "max_streams": config.getint("once", "max_streams", fallback=ONCE_DEFAULT_MAX_STREAMS),
+        "limit_rate": parse_size(config.get("once", "limit_rate", fallback="0")),
+        "hash_max_size": parse_size(config.get("once", "hash_max_size", fallback=ONCE_DEFAULT_HASH_MAX_SIZE)),
+    }
+
+
+def api_req(
+    method: str,
+    url: str,
+    verbose: bool = False,
+    profile: Optional[Profile] = None,
+    config: Optional[configparser.ConfigParser] = None,
+    idempotency_key: Optional[str] = None,
+    phase: str = "request",
+    session: Optional[requests.Session] = None,
+    **kwargs,
+):
+    profile = profile or Profile()
+
+    if config is None:
+        with profile.phase("config"):
+            config = get_config()
     if not config.has_option("once", "base_url"):
         raise ValueError(f"Configuration file at {ONCE_CONFIG_FILE} misses `base_url` option")
 
@@ -48,7 +139,7 @@ def api_req(method: str, url: str, verbose: bool = False, **kwargs):
     secret_key = base64.b64decode(os.getenv("ONCE_SECRET_KEY", config["once"]["secret_key"]))
 
     method = method.lower()
-    if method not in ["get", "post"]:
+    if method not in ["get", "post", "put"]:
         raise ValueError(f'Unsupported HTTP method "{method}"')
 
     actual_url = urljoin(base_url, url)
@@ -56,12 +147,18 @@ def api_req(method: str, url: str, verbose: bool = False, **kwargs):
     if verbose:
         print(f"{method.upper()} {actual_url}")
 
-    req = requests.Request(method=method, url=actual_url, **kwargs).prepare()
-    plain_text = req.path_url.encode("utf-8")
-    hmac_obj = hmac.new(secret_key, msg=plain_text, digestmod=hashlib.sha256)
-    req.headers[ONCE_SIGNATURE_HEADER] = base64.b64encode(hmac_obj.digest())
+    with profile.phase("sign"):
+        req = requests.Request(method=method, url=actual_url, **kwargs).prepare()
+        plain_text = req.path_url
+        if idempotency_key is not None:
+            req.headers[ONCE_IDEMPOTENCY_HEADER] = idempotency_key
+            plain_text = f"{plain_text}\n{idempotency_key}"
+        plain_text = plain_text.encode("utf-8")
+        hmac_obj = hmac.new(secret_key, msg=plain_text, digestmod=hashlib.sha256)
+        req.headers[ONCE_SIGNATURE_HEADER] = base64.b64encode(hmac_obj.digest())
 
-    response = requests.Session().send(req)
+    with profile.phase(phase):
+        response = (session or requests.Session()).send(req, timeout=ONCE_API_TIMEOUT)
 
     if verbose:
         print(f"Server response status: {response.status_code}")
@@ -70,28 +167,381 @@ def api_req(method: str, url: str, verbose: bool = False, **kwargs):
     return response
 
 
-@click.command("share")
+def upload_file(
+    upload_data: Dict,
+    file: BinaryIO,
+    filename: str,
+    profile: Optional[Profile] = None,
+    rate_limiter: Optional[TokenBucket] = None,
+    session: Optional[requests.Session] = None,
+) -> requests.Response:
+    """
+    Sends the file to S3 using the given presigned post
+    """
+    profile = profile or Profile()
+    marks = {}
+
+    def on_read(size: int):
+        now = time.perf_counter()
+        marks.setdefault("connected", now)
+        marks["sent"] = now
+        if rate_limiter is not None:
+            rate_limiter.consume(size)
+        profile.transfer(size)
+
+    body = MultipartBody(upload_data["fields"], file, filename, on_read=on_read)
+
+    started = time.perf_counter()
+    response = (session or requests).post(
+        upload_data["url"], data=body, headers={"Content-Type": body.content_type}, stream=True
+    )
+    headers_received = time.perf_counter()
+    response.content
+    profile.transfer_finished()
+
+    # The body is read as soon as the connection is established (DNS, TCP and TLS),
+    # while the response headers come back once the last byte has been sent
+    profile.record("connect", marks.get("connected", headers_received) - started)
+    profile.record("ttfb", headers_received - marks.get("sent", started))
+    profile.record("upload", time.perf_counter() - started, bytes=len(body))
+
+    return response
+
+
+def request_ticket(
+    params: Dict,
+    verbose: bool = False,
+    profile: Optional[Profile] = None,
+    config: Optional[configparser.ConfigParser] = None,
+    data: Optional[bytes] = None,
+    idempotency_key: Optional[str] = None,
+    session: Optional[requests.Session] = None,
+) -> Dict:
+    """
+    Requests an upload ticket, retrying on timeouts and server errors.
+    When `data` is given, it is uploaded inline within the same request.
+
+    Every attempt is signed with a fresh timestamp and carries the same idempotency key,
+    so that the server returns the entry created by a previous attempt, if any.
+    """
+    idempotency_key = idempotency_key or uuid.uuid4().hex
+    headers = {} if data is None else {"Content-Type": "application/octet-stream"}
+    for attempt in range(ONCE_TICKET_RETRIES + 1):
+        if attempt:
+            time.sleep(ONCE_TICKET_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+        params["t"] = datetime.utcnow().strftime(ONCE_TIMESTAMP_FORMAT)
+        try:
+            response = api_req(
+                "GET" if data is None else "PUT",
+                "/",
+                params=params,
+                data=data,
+                headers=headers,
+                verbose=verbose,
+                profile=profile,
+                config=config,
+                idempotency_key=idempotency_key,
+                phase="ticket" if data is None else "inline_upload",
+                session=session,
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == ONCE_TICKET_RETRIES:
+                raise UploadError(f"Upload ticket request failed: {e}")
+            continue
+
+        if response.status_code not in ONCE_RETRYABLE_STATUS_CODES or attempt == ONCE_TICKET_RETRIES:
+            break
+
+    entry = response.json()
+    if response.status_code != 200:
+        raise UploadError(
+            f"Upload ticket refused ({response.status_code}): {entry.get('message')}", status_code=response.status_code
+        )
+    return entry
+
+
+def upload_multipart(
+    upload_data: Dict, file: BinaryIO, part_size: int, scheduler: AdaptiveScheduler, profile: Optional[Profile] = None
+):
+    """
+    Sends the file to S3 in parts, using the given presigned multipart upload
+    """
+    profile = profile or Profile()
+    file_size = os.fstat(file.fileno()).st_size
+
+    try:
+        with profile.phase("upload", bytes=file_size):
+            parts = scheduler.upload(file.name, file_size, part_size, upload_data["part_urls"])
+            scheduler.complete(upload_data["complete_url"], parts)
+    except TransferError as e:
+        scheduler.abort(upload_data["abort_url"])
+        raise UploadError(f"Upload failed: {e}")
+
+
+def share_file(
+    file: BinaryIO,
+    verbose: bool = False,
+    profile: Optional[Profile] = None,
+    limit_rate: Optional[int] = None,
+    config: Optional[configparser.ConfigParser] = None,
+    session: Optional[requests.Session] = None,
+    idempotency_key: Optional[str] = None,
+    rate_limiter: Optional[TokenBucket] = None,
+) -> Dict:
+    """
+    Shares a binary file, returning its `once_url`.
+
+    Files up to the configured `inline_threshold` are sent along with the ticket request,
+    while files larger than `multipart_threshold` are uploaded in parts over parallel streams.
+    The upload rate is capped to `limit_rate` bytes per second, defaulting to the configured
+    `limit_rate` (0 means no limit).
+
+    Phase timings and upload throughput are collected into `profile`, when given.
+
+    Long running callers can pass a loaded `config`, a `session` pooling connections
+    and a `rate_limiter` shared by concurrent uploads. A failed share can be retried
+    with the same `idempotency_key`, to resume the same entry.
+    """
+    profile = profile or Profile()
+    filename = os.path.basename(file.name)
+
+    with profile.phase("config"):
+        if config is None:
+            config = get_config()
+        settings = get_transfer_settings(config)
+
+    if rate_limiter is None:
+        if limit_rate is None:
+            limit_rate = settings["limit_rate"]
+        rate_limiter = TokenBucket(limit_rate) if limit_rate else None
+
+    # The timestamp is set by each ticket request attempt
+    params = {"f": quote_plus(filename), "t": None}
+
+    # Hashing comes first, so that it doesn't eat up the request timestamp tolerance.
+    # Larger files are skipped, since the service only deduplicates the content it can verify.
+    file_size = os.fstat(file.fileno()).st_size
+    if file_size <= settings["hash_max_size"]:
+        with profile.phase("hash"):
+            params["h"] = content_hash(file)
+
+    # Inline uploads are authenticated through their hash
+    if file_size <= settings["inline_threshold"] and "h" in params:
+        try:
+            entry = request_ticket(
+                dict(params),
+                verbose=verbose,
+                profile=profile,
+                config=config,
+                data=file.read(),
+                idempotency_key=idempotency_key,
+                session=session,
+            )
+            return {"once_url": entry["once_url"], "uploaded": not entry.get("deduplicated", False)}
+        except UploadError as e:
+            # The service may allow smaller inline uploads than the configured threshold
+            if e.status_code != 413:
+                raise
+            file.seek(0)
+
+    part_size = None
+    if file_size > settings["multipart_threshold"]:
+        part_size = part_size_for(file_size, settings["chunk_size"])
+        params["p"] = str(-(-file_size // part_size))
+
+    entry = request_ticket(
+        params, verbose=verbose, profile=profile, config=config, idempotency_key=idempotency_key, session=session
+    )
+    result = {"once_url": entry["once_url"], "uploaded": False}
+    if "multipart_upload" in entry:
+        scheduler = AdaptiveScheduler(
+            max_streams=settings["max_streams"], rate_limiter=rate_limiter, profile=profile, session=session
+        )
+        upload_multipart(entry["multipart_upload"], file, part_size, scheduler, profile=profile)
+        result["uploaded"] = True
+    elif "presigned_post" in entry:
+        response = upload_file(
+            entry["presigned_post"], file, filename, profile=profile, rate_limiter=rate_limiter, session=session
+        )
+        if not response.ok:
+            raise UploadError(f"Upload failed ({response.status_code}): {response.text}")
+        result["uploaded"] = True
+
+    return result
+
+
+class DefaultCommandGroup(click.Group):
+    """
+    Runs the `share` command when the first argument is not a command,
+    so that `once <file>` keeps working
+    """
+
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] not in ctx.help_option_names:
+            args.insert(0, "share")
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultCommandGroup)
+def cli():
+    """
+    Shares one-time files
+    """
+
+
+def format_size(size: Optional[int]) -> str:
+    if size is None:
+        return "-"
+    for unit in ["B", "K", "M", "G"]:
+        if size < 1024 or unit == "G":
+            break
+        size /= 1024
+    return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+
+
+@cli.command("share")
 @click.argument("file", type=click.File(mode="rb"), required=True)
 @click.option("--verbose", "-v", is_flag=True, default=False, help="Enables verbose output.")
-def share(file: click.File, verbose: bool):
-    entry = api_req(
-        "GET",
-        "/",
-        params={"f": quote_plus(os.path.basename(file.name)), "t": datetime.utcnow().strftime(ONCE_TIMESTAMP_FORMAT)},
-        verbose=verbose,
-    ).json()
+@click.option(
+    "--profile",
+    "profile_output",
+    type=click.File(mode="w"),
+    default=None,
+    help="Writes phase timings and upload throughput as JSON lines to the given file (`-` for stdout).",
+)
+@click.option(
+    "--limit-rate",
+    default=None,
+    help="Caps the upload rate, in bytes per second (e.g. 512K, 2M). Overrides the `limit_rate` config option.",
+)
+def share(file: click.File, verbose: bool, profile_output: Optional[click.File], limit_rate: Optional[str]):
+    """
+    Uploads a file, printing the link to download it once
+    """
+    profile = Profile()
+    try:
+        result = share_file(
+            file, verbose=verbose, profile=profile, limit_rate=parse_size(limit_rate) if limit_rate else None
+        )
+    except (UploadError, ValueError) as e:
+        raise click.ClickException(str(e))
+    finally:
+        if profile_output is not None:
+            profile_output.write(profile.to_json_lines())
+
+    # The standard output is kept machine readable when the profile is written to it
+    err = profile_output is not None and profile_output.name == "<stdout>"
+    if result["uploaded"]:
+        upload_time = sum(phase["seconds"] for phase in profile.phases if phase["name"] in ["upload", "inline_upload"])
+        click.echo(f"File uploaded in {upload_time}s", err=err)
+    else:
+        click.echo("File already stored, upload skipped", err=err)
+    click.echo(f"File can be downloaded once at: {result['once_url']}", err=err)
+
+
+@cli.command("ls")
+@click.option("--verbose", "-v", is_flag=True, default=False, help="Enables verbose output.")
+@click.option("--limit", "-n", type=int, default=50, help="Maximum number of shares to list.")
+@click.option("--cursor", default=None, help="Lists the shares following a previous page.")
+@click.option("--stats", is_flag=True, default=False, help="Shows the totals of the shares waiting to be downloaded.")
+def ls(verbose: bool, limit: int, cursor: Optional[str], stats: bool):
+    """
+    Lists the shares waiting to be downloaded
+    """
+    params = {"t": datetime.utcnow().strftime(ONCE_TIMESTAMP_FORMAT)}
+    if stats:
+        response = api_req("GET", "/shares/stats", params=params, verbose=verbose)
+    else:
+        params["l"] = str(limit)
+        if cursor is not None:
+            params["c"] = cursor
+        response = api_req("GET", "/shares", params=params, verbose=verbose)
+
+    body = response.json()
+    if response.status_code != 200:
+        raise click.ClickException(f"Listing refused ({response.status_code}): {body.get('message')}")
+
+    if stats:
+        print(f"Shares: {body['count']} ({body['ready']} ready, {body['pending']} pending)")
+        print(f"Total size: {format_size(body['total_size'])}")
+        return
+
+    for entry in body["shares"]:
+        size = format_size(entry["size"])
+        print(f"{entry['id']}  {entry['created']:26}  {entry['state']:7}  {size:>7}  {entry['filename']}")
+
+    if "cursor" in body:
+        print(f"More shares available, run: once ls --cursor {body['cursor']}")
+
+
+@cli.command("watch")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option("--verbose", "-v", is_flag=True, default=False, help="Enables verbose output.")
+@click.option("--workers", "-w", default=4, help="Number of files shared concurrently.")
+@click.option("--queue-size", default=64, help="Number of files waiting to be shared before pausing the watcher.")
+@click.option("--retries", default=5, help="Number of attempts to share a file after a failure.")
+@click.option(
+    "--manifest",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="JSON lines file where the links are appended. Defaults to `.once-manifest.jsonl` in the watched folder.",
+)
+@click.option("--socket", "socket_path", default=None, help="Unix socket streaming the links as JSON lines.")
+@click.option("--existing", is_flag=True, default=False, help="Shares the files already in the folder too.")
+@click.option("--limit-rate", default=None, help="Caps the overall upload rate, in bytes per second (e.g. 512K, 2M).")
+def watch(
+    directory: str,
+    verbose: bool,
+    workers: int,
+    queue_size: int,
+    retries: int,
+    manifest: Optional[str],
+    socket_path: Optional[str],
+    existing: bool,
+    limit_rate: Optional[str],
+):
+    """
+    Shares every file written into a folder
+    """
+    try:
+        config = get_config()
+        settings = get_transfer_settings(config)
+        limit_rate = parse_size(limit_rate) if limit_rate else settings["limit_rate"]
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    # A single session keeps the connections alive across shares,
+    # and a single rate limiter caps the uploads of all the workers
+    session = pooled_session(workers * settings["max_streams"])
+    rate_limiter = TokenBucket(limit_rate) if limit_rate else None
+
+    share_watched_file = partial(share_file, verbose=verbose, config=config, session=session, rate_limiter=rate_limiter)
 
-    once_url = entry["once_url"]
-    upload_data = entry["presigned_post"]
-    files = {"file": file}
+    writer = ManifestWriter(manifest or os.path.join(directory, ".once-manifest.jsonl"), socket_path)
 
-    upload_started = time.time()
-    response = requests.post(upload_data["url"], data=upload_data["fields"], files=files)
+    def on_shared(record: Dict):
+        writer.write(record)
+        if "error" in record:
+            click.echo(f"Could not share {record['path']}: {record['error']}", err=True)
+        else:
+            click.echo(f"{record['path']} -> {record['once_url']}")
 
-    upload_time = time.time() - upload_started
-    print(f"File uploaded in {upload_time}s")
-    print(f"File can be downloaded once at: {once_url}")
+    pool = SharePool(
+        share_watched_file, on_shared, is_retryable, workers=workers, queue_size=queue_size, retries=retries
+    )
+    watcher = DirectoryWatcher(directory, existing=existing)
+    click.echo(f"Watching {os.path.abspath(directory)}, press Ctrl+C to stop")
+    try:
+        for path in watcher:
+            pool.submit(path)
+    except KeyboardInterrupt:
+        click.echo("Waiting for the pending shares to complete")
+    finally:
+        watcher.stop()
+        pool.join()
+        writer.close()
 
 
 if __name__ == "__main__":
-    share()
+    cli()
@@ -0,0 +1,73 @@
+"""
+Streaming multipart/form-data encoding for file uploads
+"""
+
+import os
+import uuid
+from typing import BinaryIO, Callable, Dict, Optional
+
+
+class MultipartBody:
+    """
+    A read-only file-like object encoding form fields followed by a file,
+    without loading the file in memory.
+
+    `on_read` is called with the number of bytes returned by each read,
+    which happens as soon as the connection is ready to send them.
+    """
+
+    def __init__(
+        self, fields: Dict[str, str], file: BinaryIO, filename: str, on_read: Optional[Callable[[int], None]] = None
+    ):
+        self.boundary = uuid.uuid4().hex
+        self.file = file
+        self.on_read = on_read
+
+        preamble = b"".join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8")
+            for name, value in fields.items()
+        )
+        preamble += (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+        epilogue = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+
+        file_size = os.fstat(file.fileno()).st_size - file.tell()
+        self._parts = [preamble, None, epilogue]
+        self._length = len(preamble) + file_size + len(epilogue)
+        self._offset = 0
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while self._parts and (size < 0 or size > 0):
+            part = self._parts[0]
+            if part is None:
+                chunk = self.file.read(size)
+                if not chunk:
+                    self._parts.pop(0)
+                    continue
+            else:
+                chunk = part if size < 0 else part[:size]
+                rest = part[len(chunk) :]
+                if rest:
+                    self._parts[0] = rest
+                else:
+                    self._parts.pop(0)
+
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+
+        data = b"".join(chunks)
+        if data and self.on_read is not None:
+            self.on_read(len(data))
+        return data
@@ -0,0 +1,116 @@
+"""
+Timings collected while sharing a file
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence
+
+
+DEFAULT_SAMPLE_INTERVAL = 0.25
+DEFAULT_PERCENTILES = (10, 25, 50, 75, 90, 99)
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+    """
+    Returns the p-th percentile of the given values, interpolating linearly
+    between the closest ranks
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+class Profile:
+    """
+    Collects the duration of each phase of a share operation, along with
+    the amount of bytes transferred over time.
+    """
+
+    def __init__(self, sample_interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.sample_interval = sample_interval
+        self.phases: List[Dict] = []
+        self.transferred = 0
+        self._lock = threading.Lock()
+        self._transfer_started = None
+        self._window_started = None
+        self._window_bytes = 0
+        self._samples: List[Dict] = []
+
+    def record(self, name: str, seconds: float, **attributes):
+        with self._lock:
+            self.phases.append(dict(name=name, seconds=seconds, **attributes))
+
+    @contextmanager
+    def phase(self, name: str, **attributes) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started, **attributes)
+
+    def transfer(self, size: int):
+        """
+        Accounts for `size` bytes handed over to the network
+        """
+        now = time.perf_counter()
+        with self._lock:
+            if self._transfer_started is None:
+                self._transfer_started = self._window_started = now
+
+            self.transferred += size
+            self._window_bytes += size
+
+            if now - self._window_started >= self.sample_interval:
+                self._close_window(now)
+
+    def transfer_finished(self):
+        """
+        Closes the last, possibly partial, sampling window
+        """
+        now = time.perf_counter()
+        with self._lock:
+            if self._window_bytes and now > self._window_started:
+                self._close_window(now)
+
+    def _close_window(self, now: float):
+        elapsed = now - self._window_started
+        self._samples.append(
+            {"t": self._window_started - self._transfer_started, "bytes_per_second": self._window_bytes / elapsed}
+        )
+        self._window_started = now
+        self._window_bytes = 0
+
+    @property
+    def throughput_samples(self) -> List[Dict]:
+        with self._lock:
+            return list(self._samples)
+
+    def throughput_percentiles(self, percentiles: Sequence[float] = DEFAULT_PERCENTILES) -> Dict[str, float]:
+        values = [sample["bytes_per_second"] for sample in self.throughput_samples]
+        return {f"p{p}": percentile(values, p) for p in percentiles}
+
+    def records(self) -> List[Dict]:
+        """
+        Returns every measure as a list of JSON serializable objects
+        """
+        records = [dict(event="phase", **phase) for phase in self.phases]
+        records.extend(dict(event="throughput", **sample) for sample in self.throughput_samples)
+        records.append(
+            dict(
+                event="throughput_summary",
+                bytes=self.transferred,
+                samples=len(self.throughput_samples),
+                **self.throughput_percentiles(),
+            )
+        )
+        return records
+
+    def to_json_lines(self) -> str:
+        return "".join(json.dumps(record) + "\n" for record in self.records())
@@ -0,0 +1,263 @@
+"""
+Parallel upload of large files as S3 multipart uploads
+"""
+
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+from xml.sax.saxutils import escape
+
+import requests
+
+from .profiling import Profile
+
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+# The service presigns every part in a single response, which caps the number of parts
+MAX_PARTS = 1000
+GAIN_THRESHOLD = 0.05
+
+
+class TransferError(Exception):
+    """A part could not be transferred"""
+
+    def __init__(self, message: str, retryable: bool = True, slow_down: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+        self.slow_down = slow_down
+
+
+class TokenBucket:
+    """
+    Limits the rate of a transfer to `rate` bytes per second,
+    allowing bursts up to `capacity` bytes
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int):
+        """
+        Blocks until `amount` bytes can be transferred
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Tokens are taken right away, so that concurrent callers queue up behind this one
+            self._tokens -= amount
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class FilePart:
+    """
+    A read-only file-like object over a byte range of a file
+    """
+
+    def __init__(self, path: str, offset: int, size: int, on_read: Optional[Callable[[int], None]] = None):
+        self.path = path
+        self.offset = offset
+        self.size = size
+        self.on_read = on_read
+        self._file = None
+        self._remaining = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def read(self, size: int = -1) -> bytes:
+        if self._file is None:
+            self._file = open(self.path, "rb")
+            self._file.seek(self.offset)
+
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+
+        if not data or not self._remaining:
+            self.close()
+        if data and self.on_read is not None:
+            self.on_read(len(data))
+        return data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def part_size_for(file_size: int, chunk_size: int) -> int:
+    """
+    Returns the part size closest to `chunk_size` allowed by S3 for a file of the given size,
+    growing it so that the file is split in at most MAX_PARTS parts
+    """
+    return max(chunk_size, MIN_PART_SIZE, -(-file_size // MAX_PARTS))
+
+
+class AdaptiveScheduler:
+    """
+    Uploads the parts of a file in parallel, adapting the number of streams
+    to the measured throughput.
+
+    Every time a round of parts (one per stream) is completed, a stream is
+    added as long as the throughput keeps growing, and removed when it drops.
+    Failures halve the number of streams and pause new transfers with an
+    exponential backoff, which is longer when S3 asks to slow down.
+    """
+
+    def __init__(
+        self,
+        max_streams: int = 8,
+        min_streams: int = 1,
+        initial_streams: int = 2,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        rate_limiter: Optional[TokenBucket] = None,
+        profile: Optional[Profile] = None,
+        session: Optional[requests.Session] = None,
+    ):
+        self.max_streams = max(max_streams, 1)
+        self.min_streams = max(min(min_streams, self.max_streams), 1)
+        self.streams = min(max(initial_streams, self.min_streams), self.max_streams)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate_limiter = rate_limiter
+        self.profile = profile or Profile()
+
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.max_streams)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+
+        self._resume_at = 0.0
+        self._last_throughput = None
+        self._round_started = None
+        self._round_bytes = 0
+        self._round_parts = 0
+
+    def _put_part(self, number: int, url: str, part: FilePart) -> str:
+        marks = {}
+
+        def on_read(size: int):
+            now = time.perf_counter()
+            marks.setdefault("connected", now)
+            marks["sent"] = now
+            if self.rate_limiter is not None:
+                self.rate_limiter.consume(size)
+
+        part.on_read = on_read
+        started = time.perf_counter()
+        try:
+            response = self.session.put(url, data=part)
+        except requests.RequestException as e:
+            raise TransferError(str(e))
+        finally:
+            part.close()
+        finished = time.perf_counter()
+
+        if response.status_code == 503 or "<Code>SlowDown</Code>" in response.text:
+            raise TransferError("S3 asked to slow down", slow_down=True)
+        if response.status_code >= 500:
+            raise TransferError(f"Server error ({response.status_code})")
+        if not response.ok:
+            raise TransferError(f"Part rejected ({response.status_code}): {response.text}", retryable=False)
+
+        # Only the bytes of successful parts are accounted, since failed ones are sent again
+        self.profile.transfer(part.size)
+        self.profile.record("connect", marks.get("connected", finished) - started, part=number)
+        self.profile.record("ttfb", finished - marks.get("sent", started), part=number)
+        self.profile.record("part", finished - started, part=number, bytes=part.size, streams=self.streams)
+        return response.headers["ETag"]
+
+    def _on_success(self, size: int):
+        now = time.monotonic()
+        self._round_bytes += size
+        self._round_parts += 1
+        if self._round_parts < self.streams:
+            return
+
+        throughput = self._round_bytes / max(now - self._round_started, 1e-6)
+        if self._last_throughput is None or throughput > self._last_throughput * (1 + GAIN_THRESHOLD):
+            self.streams = min(self.streams + 1, self.max_streams)
+        elif throughput < self._last_throughput * (1 - GAIN_THRESHOLD):
+            self.streams = max(self.streams - 1, self.min_streams)
+
+        self._last_throughput = throughput
+        self._start_round()
+
+    def _on_failure(self, error: TransferError, attempt: int):
+        delay = self.backoff * 2 ** (attempt - 1) * (1 + random.random())
+        if error.slow_down:
+            delay *= 2
+        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        self.streams = max(self.streams // 2, self.min_streams)
+        self._start_round()
+
+    def _start_round(self):
+        self._round_started = time.monotonic()
+        self._round_bytes = 0
+        self._round_parts = 0
+
+    def upload(self, path: str, file_size: int, part_size: int, part_urls: List[str]) -> List[Dict]:
+        """
+        Uploads the file at `path`, returning the list of uploaded parts
+        """
+        pending = deque(range(1, len(part_urls) + 1))
+        attempts = Counter()
+        uploaded = {}
+        in_flight = {}
+
+        self._start_round()
+        with ThreadPoolExecutor(max_workers=self.max_streams) as executor:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.streams and time.monotonic() >= self._resume_at:
+                    number = pending.popleft()
+                    offset = (number - 1) * part_size
+                    part = FilePart(path, offset, min(part_size, file_size - offset))
+                    future = executor.submit(self._put_part, number, part_urls[number - 1], part)
+                    in_flight[future] = (number, part.size)
+
+                if not in_flight:
+                    time.sleep(max(self._resume_at - time.monotonic(), 0))
+                    continue
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    number, size = in_flight.pop(future)
+                    try:
+                        uploaded[number] = future.result()
+                        self._on_success(size)
+                    except TransferError as e:
+                        attempts[number] += 1
+                        if not e.retryable or attempts[number] > self.max_retries:
+                            raise
+                        self._on_failure(e, attempts[number])
+                        pending.appendleft(number)
+
+        self.profile.transfer_finished()
+        return [{"PartNumber": number, "ETag": uploaded[number]} for number in sorted(uploaded)]
+
+    def complete(self, complete_url: str, parts: List[Dict]):
+        body = "".join(
+            f"<Part><PartNumber>{part['PartNumber']}</PartNumber><ETag>{escape(part['ETag'])}</ETag></Part>"
+            for part in parts
+        )
+        response = self.session.post(complete_url, data=f"<CompleteMultipartUpload>{body}</CompleteMultipartUpload>")
+        # S3 can report a failure with a 200 status code, once the response has started
+        if not response.ok or "<Error>" in response.text:
+            raise TransferError(f"Upload could not be completed ({response.status_code}): {response.text}")
+
+    def abort(self, abort_url: str):
+        self.session.delete(abort_url)
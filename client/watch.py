@@ -0,0 +1,273 @@
+"""
+Shares the files dropped into a folder, using a pool of workers
+"""
+
+import ctypes
+import ctypes.util
+import json
+import os
+import queue
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional
+
+import requests
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+POLL_INTERVAL = 1.0
+
+
+class DirectoryWatcher:
+    """
+    Yields the paths of the files written or moved into a folder.
+
+    Uses inotify when available, falling back to polling the folder.
+    Dotfiles are ignored, so that files can be written under a temporary
+    dotted name and renamed once complete.
+    """
+
+    def __init__(self, path: str, existing: bool = False):
+        self.path = os.path.abspath(path)
+        self.existing = existing
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _is_candidate(self, name: str) -> bool:
+        return not name.startswith(".") and os.path.isfile(os.path.join(self.path, name))
+
+    def _state(self, name: str) -> Optional[tuple]:
+        try:
+            stat = os.stat(os.path.join(self.path, name))
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def _scan(self) -> Dict[str, tuple]:
+        files = {}
+        for name in os.listdir(self.path):
+            if self._is_candidate(name):
+                state = self._state(name)
+                if state is not None:
+                    files[name] = state
+        return files
+
+    def __iter__(self) -> Iterator[str]:
+        # The existing files are listed once the folder is watched,
+        # so that the files written in between are not missed
+        libc_name = ctypes.util.find_library("c") if sys.platform.startswith("linux") else None
+        if libc_name is not None:
+            yield from self._watch_inotify(ctypes.CDLL(libc_name, use_errno=True))
+        else:
+            yield from self._watch_polling()
+
+    def _watch_inotify(self, libc) -> Iterator[str]:
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        try:
+            if libc.inotify_add_watch(fd, self.path.encode("utf-8"), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                raise OSError(ctypes.get_errno(), f"Could not watch {self.path}")
+
+            # Files are submitted again only when they have changed since
+            submitted = self._scan()
+            if self.existing:
+                for name in sorted(submitted):
+                    yield os.path.join(self.path, name)
+
+            while not self._stopped.is_set():
+                readable, _, _ = select.select([fd], [], [], POLL_INTERVAL)
+                if not readable:
+                    continue
+
+                buffer = os.read(fd, 64 * 1024)
+                offset = 0
+                while offset < len(buffer):
+                    _, mask, _, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+                    offset += INOTIFY_EVENT.size
+                    name = buffer[offset : offset + length].rstrip(b"\0").decode("utf-8", "surrogateescape")
+                    offset += length
+
+                    # Events have been dropped by the kernel: the folder is scanned for new or changed files
+                    if mask & IN_Q_OVERFLOW:
+                        current = self._scan()
+                        submitted = {name: state for name, state in submitted.items() if name in current}
+                        changed = sorted(name for name, state in current.items() if submitted.get(name) != state)
+                    elif name and self._is_candidate(name):
+                        changed = [name]
+                    else:
+                        changed = []
+
+                    for changed_name in changed:
+                        state = self._state(changed_name)
+                        if state is None or submitted.get(changed_name) == state:
+                            continue
+                        submitted[changed_name] = state
+                        yield os.path.join(self.path, changed_name)
+        finally:
+            os.close(fd)
+
+    def _watch_polling(self) -> Iterator[str]:
+        known = self._scan()
+        if self.existing:
+            for name in sorted(known):
+                yield os.path.join(self.path, name)
+
+        changed = {}
+        while not self._stopped.wait(POLL_INTERVAL):
+            current = self._scan()
+            for name, state in current.items():
+                if known.get(name) == state:
+                    continue
+                # Files are picked up once they have stopped changing for a whole interval
+                if changed.get(name) == state:
+                    known[name] = state
+                    del changed[name]
+                    yield os.path.join(self.path, name)
+                else:
+                    changed[name] = state
+            known = {name: state for name, state in known.items() if name in current}
+
+
+class ManifestWriter:
+    """
+    Appends the shared files to a JSON lines manifest, and broadcasts
+    them to the clients connected to an optional unix socket
+    """
+
+    def __init__(self, manifest_path: Optional[str] = None, socket_path: Optional[str] = None):
+        self._lock = threading.Lock()
+        self._manifest = open(manifest_path, "a") if manifest_path else None
+        self._clients: List[socket.socket] = []
+        self._server = None
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(socket_path)
+            self._server.listen()
+            threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self._server.accept()
+            except OSError:
+                return
+            with self._lock:
+                self._clients.append(client)
+
+    def write(self, record: Dict):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            if self._manifest is not None:
+                self._manifest.write(line)
+                self._manifest.flush()
+
+            for client in list(self._clients):
+                try:
+                    client.sendall(line.encode("utf-8"))
+                except OSError:
+                    self._clients.remove(client)
+                    client.close()
+
+    def close(self):
+        with self._lock:
+            if self._manifest is not None:
+                self._manifest.close()
+            if self._server is not None:
+                self._server.close()
+            for client in self._clients:
+                client.close()
+
+
+class SharePool:
+    """
+    Shares files through a bounded pool of workers.
+
+    `submit` blocks when `queue_size` files are already waiting, so that the
+    producer slows down to the pace of the uploads. Shares failing with an
+    error accepted by `retryable` are retried with an exponential backoff,
+    resuming the same entry.
+    """
+
+    def __init__(
+        self,
+        share: Callable[..., Dict],
+        on_shared: Callable[[Dict], None],
+        retryable: Callable[[Exception], bool],
+        workers: int = 4,
+        queue_size: int = 64,
+        retries: int = 5,
+        backoff: float = 1.0,
+    ):
+        self.share = share
+        self.on_shared = on_shared
+        self.retryable = retryable
+        self.retries = retries
+        self.backoff = backoff
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, path: str):
+        self._queue.put(path)
+
+    def join(self):
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                return
+            self.on_shared(self._share_with_retries(path))
+
+    def _share_with_retries(self, path: str) -> Dict:
+        idempotency_key = uuid.uuid4().hex
+        record = {"path": path}
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                with open(path, "rb") as file:
+                    result = self.share(file, idempotency_key=idempotency_key)
+                record.pop("error", None)
+                record.update(result, shared_at=datetime.utcnow().isoformat(), attempts=attempt + 1)
+                return record
+            except Exception as e:
+                record["error"] = str(e)
+                if not self.retryable(e):
+                    break
+
+        record["attempts"] = attempt + 1
+        return record
+
+
+def pooled_session(connections: int) -> requests.Session:
+    """
+    Returns a session keeping up to `connections` connections alive for each host
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
@@ -35,21 +35,32 @@ def on_event(event, context):
     log.debug(f'Files bucket is "{FILES_BUCKET}"')
 
     dynamodb = boto3.client("dynamodb")
-    response = dynamodb.scan(
-        TableName=FILES_TABLE_NAME,
-        Select="ALL_ATTRIBUTES",
-        FilterExpression="deleted = :deleted",
-        ExpressionAttributeValues={":deleted": {"BOOL": True}},
-    )
+    paginator = dynamodb.get_paginator("scan")
+
+    served_items = []
+    referenced_objects = set()
+    for page in paginator.paginate(TableName=FILES_TABLE_NAME, ProjectionExpression="id, object_name, deleted"):
+        for item in page["Items"]:
+            if item.get("deleted", {}).get("BOOL"):
+                served_items.append(item)
+            else:
+                referenced_objects.add(item["object_name"]["S"])
 
     s3 = boto3.client("s3")
-    for item in response["Items"]:
+    deleted_objects = set()
+    for item in served_items:
         object_name = item["object_name"]["S"]
-        log.info(f"Deleting file {object_name}")
-        try:
-            s3.delete_object(Bucket=FILES_BUCKET, Key=object_name)
-        except:
-            log.exception("Could not delete file {object_name}")
+        # Objects are shared by deduplicated entries, so they can be removed
+        # only when no pending entry is still referencing them
+        if object_name in referenced_objects:
+            log.info(f"Keeping file {object_name}, still referenced by other entries")
+        elif object_name not in deleted_objects:
+            log.info(f"Deleting file {object_name}")
+            try:
+                s3.delete_object(Bucket=FILES_BUCKET, Key=object_name)
+                deleted_objects.add(object_name)
+            except:
+                log.exception(f"Could not delete file {object_name}")
 
         response = dynamodb.delete_item(TableName=FILES_TABLE_NAME, Key={"id": item["id"]})
         log.debug(f"dynamodb delete item: {response}")
@@ -4,8 +4,10 @@ import json
 import logging
 import re
 import urllib
+from typing import Dict
 
 import boto3
+from botocore.exceptions import ClientError
 
 
 def is_debug_enabled() -> bool:
@@ -20,6 +22,7 @@ DEBUG = is_debug_enabled()
 FILES_BUCKET = os.getenv("FILES_BUCKET")
 FILES_TABLE_NAME = os.getenv("FILES_TABLE_NAME")
 PRESIGNED_URL_EXPIRES_IN = int(os.getenv("PRESIGNED_URL_EXPIRES_IN", 20))
+STATS_TABLE_NAME = os.getenv("STATS_TABLE_NAME")
 MASKED_USER_AGENTS = os.getenv(
     "MASKED_USER_AGENTS",
     ",".join(
@@ -48,6 +51,40 @@ else:
     log.setLevel(logging.INFO)
 
 
+def content_disposition(filename: str) -> str:
+    """
+    Builds an attachment Content-Disposition header value (RFC 6266), with an ASCII
+    fallback for the clients not supporting the UTF-8 encoded filename
+    """
+    fallback = "".join(c if c.isascii() and c.isprintable() and c not in '"\\' else "_" for c in filename)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{urllib.parse.quote(filename, safe='')}"
+
+
+def stats_update(**deltas: int) -> Dict:
+    """
+    Builds the transaction item adding the given deltas to the active shares counters
+    """
+    return {
+        "Update": {
+            "TableName": STATS_TABLE_NAME,
+            "Key": {"name": {"S": "active"}},
+            "UpdateExpression": "ADD " + ", ".join(f"#{name} :{name}" for name in deltas),
+            "ExpressionAttributeNames": {f"#{name}": name for name in deltas},
+            "ExpressionAttributeValues": {f":{name}": {"N": str(value)} for name, value in deltas.items()},
+        }
+    }
+
+
+def is_condition_failure(error: ClientError) -> bool:
+    """
+    Tells whether a transaction has been cancelled by the condition of its first item
+    """
+    return (
+        error.response["Error"]["Code"] == "TransactionCanceledException"
+        and error.response.get("CancellationReasons", [{}])[0].get("Code") == "ConditionalCheckFailed"
+    )
+
+
 def on_event(event, context):
     log.debug(f"Event received: {event}")
     log.debug(f"Context is: {context}")
@@ -68,26 +105,54 @@ def on_event(event, context):
         log.info(error_message)
         return {"statusCode": 404, "body": error_message}
 
+    # Entries created before upload tracking was introduced don't have the `ready` attribute
+    if not entry["Item"].get("ready", {"BOOL": True})["BOOL"]:
+        error_message = f"Entry not uploaded yet: {object_name}"
+        log.info(error_message)
+        return {"statusCode": 409, "headers": {"Retry-After": "5"}, "body": error_message}
+
+    headers = {}
+    if "file_size" in entry["Item"]:
+        headers["x-once-file-size"] = entry["Item"]["file_size"]["N"]
+
     # Some rich clients try to get a preview of any link pasted
     # into text controls.
     user_agent = event["headers"].get("user-agent", "")
     is_masked_agent = any([re.match(agent, user_agent) for agent in MASKED_USER_AGENTS])
     if is_masked_agent:
         log.info("Serving possible link preview. Download prevented.")
-        return {"statusCode": 200, "headers": {}}
+        return {"statusCode": 200, "headers": headers}
 
-    s3 = boto3.client("s3")
-    download_url = s3.generate_presigned_url(
-        "get_object", Params={"Bucket": FILES_BUCKET, "Key": object_name}, ExpiresIn=PRESIGNED_URL_EXPIRES_IN
-    )
+    # Deduplicated entries share the object stored by a previous upload
+    params = {"Bucket": FILES_BUCKET, "Key": entry["Item"]["object_name"]["S"]}
+    if params["Key"] != object_name:
+        params["ResponseContentDisposition"] = content_disposition(filename)
 
-    dynamodb.update_item(
-        TableName=FILES_TABLE_NAME,
-        Key={"id": {"S": entry_id}},
-        UpdateExpression="SET deleted = :deleted",
-        ExpressionAttributeValues={":deleted": {"BOOL": True}},
-    )
+    s3 = boto3.client("s3")
+    download_url = s3.generate_presigned_url("get_object", Params=params, ExpiresIn=PRESIGNED_URL_EXPIRES_IN)
+
+    update = {
+        "TableName": FILES_TABLE_NAME,
+        "Key": {"id": {"S": entry_id}},
+        "UpdateExpression": "SET deleted = :deleted REMOVE listed",
+        "ExpressionAttributeValues": {":deleted": {"BOOL": True}},
+    }
+    # Listed entries are no longer counted as active shares, in the same transaction
+    file_size = int(entry["Item"].get("file_size", {"N": "0"})["N"])
+    try:
+        dynamodb.transact_write_items(
+            TransactItems=[
+                {"Update": dict(update, ConditionExpression="attribute_exists(listed)")},
+                stats_update(count=-1, ready=-1, total_size=-file_size),
+            ]
+        )
+    except ClientError as e:
+        if not is_condition_failure(e):
+            raise
+        # Entries created before the listing, or served by a concurrent request
+        dynamodb.update_item(**update)
 
     log.info(f"Entry {object_name} marked as deleted")
 
-    return {"statusCode": 301, "headers": {"Location": download_url}}
+    headers["Location"] = download_url
+    return {"statusCode": 301, "headers": headers}
@@ -5,9 +5,11 @@ import json
 import logging
 import os
 import random
+import re
 import string
+import time
 from datetime import datetime, timedelta
-from typing import Dict
+from typing import Dict, Optional
 from urllib.parse import quote, quote_plus, unquote_plus, urlencode
 
 import boto3
@@ -26,16 +28,27 @@ def is_debug_enabled() -> bool:
 
 DEBUG = is_debug_enabled()
 APP_URL = os.getenv("APP_URL")
+CONTENT_HASH_INDEX_NAME = os.getenv("CONTENT_HASH_INDEX_NAME", "content-hash-index")
 EXPIRATION_TIMEOUT = int(os.getenv("EXPIRATION_TIMEOUT", 60 * 5))
 FILES_BUCKET = os.getenv("FILES_BUCKET")
 FILES_TABLE_NAME = os.getenv("FILES_TABLE_NAME")
+IDEMPOTENCY_HEADER = os.getenv("IDEMPOTENCY_HEADER", "x-once-idempotency-key")
+IDEMPOTENCY_TABLE_NAME = os.getenv("IDEMPOTENCY_TABLE_NAME")
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 60 * 60))
+INLINE_UPLOAD_MAX_SIZE = int(os.getenv("INLINE_UPLOAD_MAX_SIZE", 1024 * 1024))
+# Every presigned part URL is returned at once, within the 6 MB limit of Lambda responses
+MAX_PARTS = 1000
+MULTIPART_EXPIRATION_TIMEOUT = int(os.getenv("MULTIPART_EXPIRATION_TIMEOUT", 60 * 60 * 12))
 S3_REGION_NAME = os.getenv("S3_REGION_NAME", "eu-west-1")
 S3_SIGNATURE_VERSION = os.getenv("S3_SIGNATURE_VERSION", "s3v4")
 SECRET_KEY = base64.b64decode(os.getenv("SECRET_KEY"))
 SIGNATURE_HEADER = os.getenv("SIGNATURE_HEADER", "x-once-signature")
 SIGNATURE_TIME_TOLERANCE = int(os.getenv("SIGNATURE_TIME_TOLERANCE", 5))
+STATS_TABLE_NAME = os.getenv("STATS_TABLE_NAME")
 TIMESTAMP_FORMAT_STRING = os.getenv("TIMESTAMP_FORMAT_STRING", "%d%m%Y%H%M%S")
 TIMESTAMP_PARAMETER_FORMAT = "%Y%m%d%H%M%S%f"
+CONTENT_HASH_PATTERN = re.compile("^[0-9a-f]{64}$")
+IDEMPOTENCY_KEY_PATTERN = re.compile("^[0-9A-Za-z_-]{16,64}$")
 
 
 log = logging.getLogger()
@@ -53,6 +66,10 @@ class UnauthorizedError(Exception):
     pass
 
 
+class PayloadTooLargeError(Exception):
+    pass
+
+
 def create_presigned_post(bucket_name: str, object_name: str, fields=None, conditions=None, expiration=3600) -> Dict:
     """
     Generate a presigned URL S3 POST request to upload a file
@@ -64,12 +81,214 @@ def create_presigned_post(bucket_name: str, object_name: str, fields=None, condi
     )
 
 
+def create_presigned_multipart_upload(bucket_name: str, object_name: str, parts: int, expiration=3600) -> Dict:
+    """
+    Starts a multipart upload, returning the presigned URLs to upload
+    each part and to complete or abort the upload
+    """
+    s3_client = boto3.client("s3", region_name=S3_REGION_NAME, config=Config(signature_version=S3_SIGNATURE_VERSION))
+
+    upload_id = s3_client.create_multipart_upload(Bucket=bucket_name, Key=object_name)["UploadId"]
+    params = {"Bucket": bucket_name, "Key": object_name, "UploadId": upload_id}
+
+    return {
+        "upload_id": upload_id,
+        "part_urls": [
+            s3_client.generate_presigned_url(
+                "upload_part", Params=dict(params, PartNumber=number), ExpiresIn=expiration, HttpMethod="PUT"
+            )
+            for number in range(1, parts + 1)
+        ],
+        "complete_url": s3_client.generate_presigned_url(
+            "complete_multipart_upload", Params=params, ExpiresIn=expiration, HttpMethod="POST"
+        ),
+        "abort_url": s3_client.generate_presigned_url(
+            "abort_multipart_upload", Params=params, ExpiresIn=expiration, HttpMethod="DELETE"
+        ),
+    }
+
+
+def find_stored_object(content_hash: str) -> Optional[Dict]:
+    """
+    Looks for an object already stored in the files bucket with the given
+    content hash, returning its name, size and ETag.
+
+    Only entries whose content has been verified server-side are indexed,
+    and their object must not have been overwritten since.
+    """
+    dynamodb = boto3.client("dynamodb")
+    # The objects of served entries may be removed by the cleanup at any time
+    response = dynamodb.query(
+        TableName=FILES_TABLE_NAME,
+        IndexName=CONTENT_HASH_INDEX_NAME,
+        KeyConditionExpression="content_hash = :content_hash",
+        FilterExpression="attribute_not_exists(deleted)",
+        ExpressionAttributeValues={":content_hash": {"S": content_hash}},
+    )
+
+    s3 = boto3.client("s3")
+    for item in response["Items"]:
+        object_name = item["object_name"]["S"]
+        try:
+            head = s3.head_object(Bucket=FILES_BUCKET, Key=object_name)
+        except ClientError:
+            log.debug(f"Object {object_name} is not available")
+            continue
+
+        if head["ETag"] == item["etag"]["S"]:
+            return {"object_name": object_name, "file_size": head["ContentLength"], "etag": head["ETag"]}
+        log.warning(f"Object {object_name} has changed since its content was verified")
+
+    return None
+
+
+def create_entry(filename: str, content_hash: Optional[str] = None) -> Dict:
+    """
+    Builds a new files table item, pointing at an already stored object
+    with the same content hash when available
+    """
+    domain = string.ascii_uppercase + string.ascii_lowercase + string.digits
+    entry_id = "".join(random.choice(domain) for _ in range(6))
+
+    # Entries become ready once the upload has completed,
+    # unless they share an object which is already stored
+    item = {
+        "id": {"S": entry_id},
+        "object_name": {"S": f"{entry_id}/{filename}"},
+        "filename": {"S": filename},
+        "ready": {"BOOL": False},
+        "created_at": {"S": datetime.utcnow().isoformat()},
+        # Only entries having this attribute are included in the active shares index
+        "listed": {"S": "active"},
+    }
+
+    # The hash sent by the client is only indexed once the uploaded content has been verified
+    if content_hash is not None:
+        stored_object = find_stored_object(content_hash)
+        if stored_object is not None:
+            item["content_hash"] = {"S": content_hash}
+            item["object_name"] = {"S": stored_object["object_name"]}
+            item["ready"] = {"BOOL": True}
+            item["file_size"] = {"N": str(stored_object["file_size"])}
+            item["etag"] = {"S": stored_object["etag"]}
+        else:
+            item["expected_hash"] = {"S": content_hash}
+
+    return item
+
+
+def stats_update(**deltas: int) -> Dict:
+    """
+    Builds the transaction item adding the given deltas to the active shares counters
+    """
+    return {
+        "Update": {
+            "TableName": STATS_TABLE_NAME,
+            "Key": {"name": {"S": "active"}},
+            "UpdateExpression": "ADD " + ", ".join(f"#{name} :{name}" for name in deltas),
+            "ExpressionAttributeNames": {f"#{name}": name for name in deltas},
+            "ExpressionAttributeValues": {f":{name}": {"N": str(value)} for name, value in deltas.items()},
+        }
+    }
+
+
+def is_condition_failure(error: ClientError) -> bool:
+    """
+    Tells whether a transaction has been cancelled by the condition of its first item
+    """
+    return (
+        error.response["Error"]["Code"] == "TransactionCanceledException"
+        and error.response.get("CancellationReasons", [{}])[0].get("Code") == "ConditionalCheckFailed"
+    )
+
+
+def put_entry(item: Dict, **kwargs):
+    """
+    Writes a new entry, counting it as an active share in the same transaction
+    """
+    if item["ready"]["BOOL"]:
+        counters = stats_update(count=1, ready=1, total_size=int(item["file_size"]["N"]))
+    else:
+        counters = stats_update(count=1, pending=1)
+
+    entry = {"Put": dict(TableName=FILES_TABLE_NAME, Item=item, **kwargs)}
+
+    dynamodb = boto3.client("dynamodb")
+    dynamodb.transact_write_items(TransactItems=[entry, counters])
+
+
+def get_inline_body(event: Dict) -> bytes:
+    body = event.get("body") or ""
+    if event.get("isBase64Encoded"):
+        return base64.b64decode(body)
+    return body.encode("utf-8")
+
+
+def store_inline_upload(item: Dict, body: bytes):
+    """
+    Stores the body of an inline upload as the object of the given entry,
+    marking it as ready
+    """
+    s3 = boto3.client("s3")
+    response = s3.put_object(Bucket=FILES_BUCKET, Key=item["object_name"]["S"], Body=body)
+
+    item["ready"] = {"BOOL": True}
+    item["file_size"] = {"N": str(len(body))}
+    item["etag"] = {"S": response["ETag"]}
+    # The body has already been checked against the hash sent by the client
+    item["content_hash"] = item.pop("expected_hash")
+
+
+def get_idempotency_record(idempotency_key: str) -> Optional[Dict]:
+    dynamodb = boto3.client("dynamodb")
+    response = dynamodb.get_item(
+        TableName=IDEMPOTENCY_TABLE_NAME, Key={"idempotency_key": {"S": idempotency_key}}, ConsistentRead=True
+    )
+
+    # Expired items are removed by DynamoDB with some delay
+    record = response.get("Item")
+    if record is None or int(record["expires_at"]["N"]) < time.time():
+        return None
+    return record
+
+
+def claim_idempotency_key(idempotency_key: str, once_url: str, item: Dict) -> Optional[Dict]:
+    """
+    Records the entry created for a request with the given idempotency key,
+    returning the record of a concurrent request which claimed it first, if any
+    """
+    now = int(time.time())
+    dynamodb = boto3.client("dynamodb")
+    try:
+        dynamodb.put_item(
+            TableName=IDEMPOTENCY_TABLE_NAME,
+            Item={
+                "idempotency_key": {"S": idempotency_key},
+                "once_url": {"S": once_url},
+                "entry": {"M": item},
+                "expires_at": {"N": str(now + IDEMPOTENCY_TTL)},
+            },
+            ConditionExpression="attribute_not_exists(idempotency_key) OR expires_at < :now",
+            ExpressionAttributeValues={":now": {"N": str(now)}},
+        )
+        return None
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return get_idempotency_record(idempotency_key)
+
+
 def validate_signature(event: Dict, secret_key: bytes) -> bool:
     canonicalized_url = event["rawPath"]
     if "queryStringParameters" in event:
         qs = urlencode(event["queryStringParameters"], quote_via=quote_plus)
         canonicalized_url = f"{canonicalized_url}?{qs}"
 
+    # The idempotency key is signed along with the url
+    idempotency_key = event["headers"].get(IDEMPOTENCY_HEADER)
+    if idempotency_key is not None:
+        canonicalized_url = f"{canonicalized_url}\n{idempotency_key}"
+
     plain_text = canonicalized_url.encode("utf-8")
     log.debug(f"Plain text: {plain_text}")
 
@@ -109,9 +328,13 @@ def on_event(event, context):
     log.debug(f'S3 signature algorithm version is "{S3_SIGNATURE_VERSION}"')
     log.debug(f"Pre-signed urls will expire after {EXPIRATION_TIMEOUT} seconds")
 
+    method = event.get("requestContext", {}).get("http", {}).get("method", "GET")
     q = event.get("queryStringParameters", {})
     filename = unquote_plus(q.get("f"))
     timestamp = unquote_plus(q.get("t"))
+    content_hash = q.get("h")
+    parts = q.get("p")
+    idempotency_key = event["headers"].get(IDEMPOTENCY_HEADER)
 
     response_code = 200
     response = {}
@@ -122,6 +345,30 @@ def on_event(event, context):
         if timestamp is None:
             raise BadRequestError("Please provide a valid value for the `t` query parameter")
 
+        if content_hash is not None and not CONTENT_HASH_PATTERN.match(content_hash):
+            raise BadRequestError("The `h` query parameter must be an hex encoded SHA-256 digest")
+
+        if parts is not None:
+            if not parts.isdigit() or not 1 <= int(parts) <= MAX_PARTS:
+                raise BadRequestError(f"The `p` query parameter must be a number of parts between 1 and {MAX_PARTS}")
+            parts = int(parts)
+
+        # Inline uploads are authenticated through the signed content hash
+        body = None
+        if method == "PUT":
+            if content_hash is None:
+                raise BadRequestError("Inline uploads require the `h` query parameter")
+
+            body = get_inline_body(event)
+            if len(body) > INLINE_UPLOAD_MAX_SIZE:
+                raise PayloadTooLargeError(f"Inline uploads are limited to {INLINE_UPLOAD_MAX_SIZE} bytes")
+
+            if hashlib.sha256(body).hexdigest() != content_hash:
+                raise BadRequestError("The uploaded content doesn't match the `h` query parameter")
+
+        if idempotency_key is not None and not IDEMPOTENCY_KEY_PATTERN.match(idempotency_key):
+            raise BadRequestError(f"The `{IDEMPOTENCY_HEADER}` header must be made of 16 to 64 letters or digits")
+
         if not validate_timestamp(timestamp):
             log.error("Request timestamp is not valid")
             raise UnauthorizedError("Your request cannot be authorized")
@@ -130,31 +377,79 @@ def on_event(event, context):
             log.error("Request signature is not valid")
             raise UnauthorizedError("Your request cannot be authorized")
 
-        domain = string.ascii_uppercase + string.ascii_lowercase + string.digits
-        entry_id = "".join(random.choice(domain) for _ in range(6))
-        object_name = f"{entry_id}/{filename}"
-        response["once_url"] = f"{APP_URL}{entry_id}/{quote(filename)}"
-
-        dynamodb = boto3.client("dynamodb")
-        dynamodb.put_item(TableName=FILES_TABLE_NAME, Item={"id": {"S": entry_id}, "object_name": {"S": object_name}})
-
-        log.debug(
-            f"Creating pre-signed post for {object_name} on " f"{FILES_BUCKET} (expiration={EXPIRATION_TIMEOUT})"
-        )
-
-        presigned_post = create_presigned_post(
-            bucket_name=FILES_BUCKET, object_name=object_name, expiration=EXPIRATION_TIMEOUT
-        )
-
-        log.info(f"Authorized upload request for {object_name}")
-        log.debug(f"Presigned-Post response: {presigned_post}")
-        response["presigned_post"] = presigned_post
+        record = None
+        if idempotency_key is not None:
+            record = get_idempotency_record(idempotency_key)
+
+        if record is None:
+            item = create_entry(filename, content_hash)
+            once_url = f"{APP_URL}{item['id']['S']}/{quote(filename)}"
+
+            stored_inline = body is not None and not item["ready"]["BOOL"]
+            if stored_inline:
+                store_inline_upload(item, body)
+
+            if idempotency_key is not None:
+                record = claim_idempotency_key(idempotency_key, once_url, item)
+
+            # A concurrent request with the same idempotency key has already stored the file
+            if record is not None and stored_inline:
+                boto3.client("s3").delete_object(Bucket=FILES_BUCKET, Key=item["object_name"]["S"])
+
+        if record is None:
+            put_entry(item)
+        else:
+            # The entry may be missing, when the original request failed before writing it
+            log.info(f"Replaying the request with idempotency key {idempotency_key}")
+            item = record["entry"]["M"]
+            once_url = record["once_url"]["S"]
+            try:
+                put_entry(item, ConditionExpression="attribute_not_exists(id)")
+            except ClientError as e:
+                if not is_condition_failure(e):
+                    raise
+
+        object_name = item["object_name"]["S"]
+        response["once_url"] = once_url
+        # Entries sharing the object of another entry don't need any upload
+        response["deduplicated"] = not object_name.startswith(f"{item['id']['S']}/")
+
+        if response["deduplicated"]:
+            log.info(f"Authorized {once_url} sharing the stored object {object_name}")
+        elif body is not None:
+            log.info(f"Stored inline upload {object_name}")
+        elif parts is not None:
+            log.debug(
+                f"Creating multipart upload of {parts} parts for {object_name} on "
+                f"{FILES_BUCKET} (expiration={MULTIPART_EXPIRATION_TIMEOUT})"
+            )
+
+            response["multipart_upload"] = create_presigned_multipart_upload(
+                bucket_name=FILES_BUCKET, object_name=object_name, parts=parts, expiration=MULTIPART_EXPIRATION_TIMEOUT
+            )
+
+            log.info(f"Authorized multipart upload request for {object_name}")
+        else:
+            log.debug(
+                f"Creating pre-signed post for {object_name} on " f"{FILES_BUCKET} (expiration={EXPIRATION_TIMEOUT})"
+            )
+
+            presigned_post = create_presigned_post(
+                bucket_name=FILES_BUCKET, object_name=object_name, expiration=EXPIRATION_TIMEOUT
+            )
+
+            log.info(f"Authorized upload request for {object_name}")
+            log.debug(f"Presigned-Post response: {presigned_post}")
+            response["presigned_post"] = presigned_post
     except BadRequestError as e:
         response_code = 400
         response = dict(message=str(e))
-    except UnauthorizedError:
+    except UnauthorizedError as e:
         response_code = 401
         response = dict(message=str(e))
+    except PayloadTooLargeError as e:
+        response_code = 413
+        response = dict(message=str(e))
     except Exception as e:
         response_code = 500
         response = dict(message=str(e))
@@ -0,0 +1,208 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from urllib.parse import quote_plus, urlencode
+
+import boto3
+from boto3.dynamodb.types import TypeDeserializer
+
+
+def is_debug_enabled() -> bool:
+    value = os.getenv("DEBUG", "false").lower()
+    if value in ["false", "0"]:
+        return False
+    else:
+        return bool(value)
+
+
+DEBUG = is_debug_enabled()
+ACTIVE_SHARES_INDEX_NAME = os.getenv("ACTIVE_SHARES_INDEX_NAME", "active-shares-index")
+CURSOR_KEYS = {"id", "listed", "created_at"}
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", 50))
+FILES_TABLE_NAME = os.getenv("FILES_TABLE_NAME")
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 1000))
+SECRET_KEY = base64.b64decode(os.getenv("SECRET_KEY"))
+SIGNATURE_HEADER = os.getenv("SIGNATURE_HEADER", "x-once-signature")
+SIGNATURE_TIME_TOLERANCE = int(os.getenv("SIGNATURE_TIME_TOLERANCE", 5))
+STATS_COUNTERS = ["count", "ready", "pending", "total_size"]
+STATS_TABLE_NAME = os.getenv("STATS_TABLE_NAME")
+TIMESTAMP_PARAMETER_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+log = logging.getLogger()
+if DEBUG:
+    log.setLevel(logging.DEBUG)
+else:
+    log.setLevel(logging.INFO)
+
+
+class BadRequestError(Exception):
+    pass
+
+
+class UnauthorizedError(Exception):
+    pass
+
+
+def validate_signature(event: Dict, secret_key: bytes) -> bool:
+    canonicalized_url = event["rawPath"]
+    if "queryStringParameters" in event:
+        qs = urlencode(event["queryStringParameters"], quote_via=quote_plus)
+        canonicalized_url = f"{canonicalized_url}?{qs}"
+
+    plain_text = canonicalized_url.encode("utf-8")
+    log.debug(f"Plain text: {plain_text}")
+
+    encoded_signature = event["headers"][SIGNATURE_HEADER]
+    log.debug(f"Received signature: {encoded_signature}")
+
+    signature_value = base64.b64decode(encoded_signature)
+
+    hmac_obj = hmac.new(secret_key, msg=plain_text, digestmod=hashlib.sha256)
+
+    calculated_signature = hmac_obj.digest()
+    return calculated_signature == signature_value
+
+
+def validate_timestamp(timestamp: str, current_time: datetime = None) -> bool:
+    if current_time is None:
+        current_time = datetime.utcnow()
+
+    try:
+        request_time = datetime.strptime(timestamp, TIMESTAMP_PARAMETER_FORMAT)
+        return current_time - request_time <= timedelta(seconds=SIGNATURE_TIME_TOLERANCE)
+    except:
+        log.error(f"Could not validate timestamp {timestamp} according to the format: {TIMESTAMP_PARAMETER_FORMAT}")
+        return False
+
+
+def encode_cursor(last_evaluated_key: Dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key).encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor: str) -> Dict:
+    """
+    Decodes a cursor into the key of the active shares index it starts from
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))
+    except (binascii.Error, ValueError):
+        raise BadRequestError("The `c` query parameter is not a valid cursor")
+
+    # The cursor is handed over to DynamoDB, which must only receive a key of the index
+    if (
+        not isinstance(key, dict)
+        or set(key) != CURSOR_KEYS
+        or not all(isinstance(value, dict) and list(value) == ["S"] for value in key.values())
+        or not all(isinstance(value["S"], str) for value in key.values())
+        or key["listed"]["S"] != "active"
+    ):
+        raise BadRequestError("The `c` query parameter is not a valid cursor")
+    return key
+
+
+def query_active_shares(**kwargs) -> Dict:
+    dynamodb = boto3.client("dynamodb")
+    return dynamodb.query(
+        TableName=FILES_TABLE_NAME,
+        IndexName=ACTIVE_SHARES_INDEX_NAME,
+        KeyConditionExpression="listed = :listed",
+        ExpressionAttributeValues={":listed": {"S": "active"}},
+        **kwargs,
+    )
+
+
+def list_shares(limit: int, cursor: Optional[str] = None) -> Dict:
+    """
+    Returns a page of active shares, from the most recent one
+    """
+    kwargs = {"ScanIndexForward": False, "Limit": limit}
+    if cursor is not None:
+        kwargs["ExclusiveStartKey"] = decode_cursor(cursor)
+
+    response = query_active_shares(**kwargs)
+
+    deserializer = TypeDeserializer()
+    shares = []
+    for item in response["Items"]:
+        entry = {key: deserializer.deserialize(value) for key, value in item.items()}
+        shares.append(
+            {
+                "id": entry["id"],
+                "filename": entry.get("filename", entry["object_name"].split("/", 1)[-1]),
+                "size": int(entry["file_size"]) if "file_size" in entry else None,
+                "created": entry["created_at"],
+                "state": "ready" if entry.get("ready", True) else "pending",
+            }
+        )
+
+    page = {"shares": shares}
+    if "LastEvaluatedKey" in response:
+        page["cursor"] = encode_cursor(response["LastEvaluatedKey"])
+    return page
+
+
+def get_stats() -> Dict:
+    """
+    Reads the active shares counters, updated along with the entries by the other handlers
+    """
+    dynamodb = boto3.client("dynamodb")
+    response = dynamodb.get_item(TableName=STATS_TABLE_NAME, Key={"name": {"S": "active"}})
+
+    item = response.get("Item", {})
+    return {counter: int(item.get(counter, {"N": "0"})["N"]) for counter in STATS_COUNTERS}
+
+
+def on_event(event, context):
+    log.debug(f"Event received: {event}")
+    log.debug(f"Context is: {context}")
+    log.debug(f"Debug mode is {DEBUG}")
+    log.debug(f'Files Dynamodb table name is "{FILES_TABLE_NAME}"')
+
+    q = event.get("queryStringParameters", {})
+    timestamp = q.get("t")
+    limit = q.get("l", str(DEFAULT_PAGE_SIZE))
+    cursor = q.get("c")
+
+    response_code = 200
+    response = {}
+    try:
+        if timestamp is None:
+            raise BadRequestError("Please provide a valid value for the `t` query parameter")
+
+        if not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_SIZE:
+            raise BadRequestError(f"The `l` query parameter must be a number between 1 and {MAX_PAGE_SIZE}")
+
+        if not validate_timestamp(timestamp):
+            log.error("Request timestamp is not valid")
+            raise UnauthorizedError("Your request cannot be authorized")
+
+        if not validate_signature(event, SECRET_KEY):
+            log.error("Request signature is not valid")
+            raise UnauthorizedError("Your request cannot be authorized")
+
+        if event["rawPath"].rstrip("/").endswith("/stats"):
+            response = get_stats()
+        else:
+            response = list_shares(int(limit), cursor)
+    except BadRequestError as e:
+        response_code = 400
+        response = dict(message=str(e))
+    except UnauthorizedError as e:
+        response_code = 401
+        response = dict(message=str(e))
+    except Exception as e:
+        response_code = 500
+        response = dict(message=str(e))
+    finally:
+        return {
+            "statusCode": response_code,
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps(response),
+        }
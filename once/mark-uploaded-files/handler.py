@@ -0,0 +1,159 @@
+import os
+import hashlib
+import logging
+from typing import Dict, Optional
+from urllib.parse import unquote_plus
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+def is_debug_enabled() -> bool:
+    value = os.getenv("DEBUG", "false").lower()
+    if value in ["false", "0"]:
+        return False
+    else:
+        return bool(value)
+
+
+DEBUG = is_debug_enabled()
+FILES_TABLE_NAME = os.getenv("FILES_TABLE_NAME")
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_VERIFICATION_MAX_SIZE = int(os.getenv("HASH_VERIFICATION_MAX_SIZE", 512 * 1024 * 1024))
+STATS_TABLE_NAME = os.getenv("STATS_TABLE_NAME")
+
+
+log = logging.getLogger()
+if DEBUG:
+    log.setLevel(logging.DEBUG)
+else:
+    log.setLevel(logging.INFO)
+
+
+def stats_update(**deltas: int) -> Dict:
+    """
+    Builds the transaction item adding the given deltas to the active shares counters
+    """
+    return {
+        "Update": {
+            "TableName": STATS_TABLE_NAME,
+            "Key": {"name": {"S": "active"}},
+            "UpdateExpression": "ADD " + ", ".join(f"#{name} :{name}" for name in deltas),
+            "ExpressionAttributeNames": {f"#{name}": name for name in deltas},
+            "ExpressionAttributeValues": {f":{name}": {"N": str(value)} for name, value in deltas.items()},
+        }
+    }
+
+
+def is_condition_failure(error: ClientError) -> bool:
+    """
+    Tells whether a transaction has been cancelled by the condition of its first item
+    """
+    return (
+        error.response["Error"]["Code"] == "TransactionCanceledException"
+        and error.response.get("CancellationReasons", [{}])[0].get("Code") == "ConditionalCheckFailed"
+    )
+
+
+def mark_ready(object_name: str, file_size: int, etag: str) -> Optional[Dict]:
+    """
+    Marks the entry of an uploaded object as ready, returning the updated entry if any.
+
+    The first upload of a listed entry moves it from the pending to the ready
+    shares counters, in the same transaction.
+    """
+    key = {"id": {"S": object_name.split("/", 1)[0]}}
+    update = {
+        "TableName": FILES_TABLE_NAME,
+        "Key": key,
+        "UpdateExpression": "SET ready = :ready, file_size = :file_size, etag = :etag",
+        "ExpressionAttributeValues": {
+            ":ready": {"BOOL": True},
+            ":file_size": {"N": str(file_size)},
+            ":etag": {"S": etag},
+            ":object_name": {"S": object_name},
+        },
+    }
+
+    dynamodb = boto3.client("dynamodb")
+    try:
+        first_upload = dict(
+            update,
+            ConditionExpression="object_name = :object_name AND ready = :pending AND attribute_exists(listed)",
+            ExpressionAttributeValues=dict(update["ExpressionAttributeValues"], **{":pending": {"BOOL": False}}),
+        )
+        dynamodb.transact_write_items(
+            TransactItems=[{"Update": first_upload}, stats_update(pending=-1, ready=1, total_size=file_size)]
+        )
+        return dynamodb.get_item(TableName=FILES_TABLE_NAME, Key=key, ConsistentRead=True)["Item"]
+    except ClientError as e:
+        if not is_condition_failure(e):
+            raise
+
+    # Objects uploaded again through the same presigned post keep the counted size
+    try:
+        response = dynamodb.update_item(
+            **update, ConditionExpression="object_name = :object_name", ReturnValues="ALL_NEW"
+        )
+        return response["Attributes"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return None
+
+
+def verify_content_hash(bucket_name: str, object_name: str, entry: Dict):
+    """
+    Hashes the uploaded object, indexing the entry by its content hash
+    only when it matches the one sent by the client
+    """
+    s3 = boto3.client("s3")
+    response = s3.get_object(Bucket=bucket_name, Key=object_name)
+    hash_obj = hashlib.sha256()
+    for chunk in response["Body"].iter_chunks(HASH_CHUNK_SIZE):
+        hash_obj.update(chunk)
+
+    # The ETag of the hashed object is stored too, since a presigned post
+    # can be used again to overwrite the object until it expires
+    if hash_obj.hexdigest() == entry["expected_hash"]["S"]:
+        update_expression = "SET content_hash = :content_hash, etag = :etag"
+        values = {":content_hash": entry["expected_hash"], ":etag": {"S": response["ETag"]}}
+        log.info(f"Content of {object_name} verified")
+    else:
+        update_expression = "REMOVE content_hash"
+        values = {}
+        log.warning(f"Content of {object_name} doesn't match the hash sent by the client")
+
+    dynamodb = boto3.client("dynamodb")
+    dynamodb.update_item(
+        TableName=FILES_TABLE_NAME,
+        Key={"id": entry["id"]},
+        UpdateExpression=update_expression,
+        ConditionExpression="object_name = :object_name",
+        ExpressionAttributeValues=dict(values, **{":object_name": {"S": object_name}}),
+    )
+
+
+def on_event(event, context):
+    log.debug(f"Event received: {event}")
+    log.debug(f"Context is: {context}")
+    log.debug(f"Debug mode is {DEBUG}")
+
+    for record in event["Records"]:
+        bucket_name = record["s3"]["bucket"]["name"]
+        s3_object = record["s3"]["object"]
+        object_name = unquote_plus(s3_object["key"])
+        file_size = s3_object.get("size", 0)
+        # Notifications carry the ETag without the quotes returned by the S3 API,
+        # which is the format stored in the entries and compared against
+        etag = f'"{s3_object["eTag"]}"' if s3_object.get("eTag") else ""
+
+        entry = mark_ready(object_name, file_size, etag)
+        if entry is None:
+            log.info(f"No entry found for the uploaded file {object_name}")
+            continue
+        log.info(f"Entry {object_name} marked as ready")
+
+        # Larger files are never deduplicated, rather than being read back in full
+        if "expected_hash" in entry and file_size <= HASH_VERIFICATION_MAX_SIZE:
+            verify_content_hash(bucket_name, object_name, entry)
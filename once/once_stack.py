@@ -16,13 +16,18 @@ from aws_cdk import (
     aws_route53 as route53,
     aws_route53_targets as route53_targets,
     aws_s3 as s3,
+    aws_s3_notifications as s3n,
 )
 
 from .utils import make_python_zip_bundle
 
 
 BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+INLINE_UPLOAD_MAX_SIZE = int(os.getenv("INLINE_UPLOAD_MAX_SIZE", 1024 * 1024))
 LOG_RETENTION = getattr(logs.RetentionDays, os.getenv("LOG_RETENTION", "TWO_WEEKS"))
+# CloudFormation creates a single global secondary index per table update,
+# so deployments predating both indexes are upgraded in two steps
+SKIP_ACTIVE_SHARES_INDEX = os.getenv("SKIP_ACTIVE_SHARES_INDEX", "false").lower() not in ["false", "0"]
 
 
 @jsii.implements(route53.IAliasRecordTarget)
@@ -109,6 +114,7 @@ class OnceStack(core.Stack):
             block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
             encryption=s3.BucketEncryption.S3_MANAGED,
             removal_policy=core.RemovalPolicy.DESTROY,
+            lifecycle_rules=[s3.LifecycleRule(abort_incomplete_multipart_upload_after=core.Duration.days(1))],
         )
 
         self.files_table = dynamodb.Table(
@@ -120,6 +126,42 @@ class OnceStack(core.Stack):
             removal_policy=core.RemovalPolicy.DESTROY,
         )
 
+        self.files_table.add_global_secondary_index(
+            index_name="content-hash-index",
+            partition_key=dynamodb.Attribute(name="content_hash", type=dynamodb.AttributeType.STRING),
+            projection_type=dynamodb.ProjectionType.INCLUDE,
+            non_key_attributes=["object_name", "etag", "deleted"],
+        )
+
+        if not SKIP_ACTIVE_SHARES_INDEX:
+            self.files_table.add_global_secondary_index(
+                index_name="active-shares-index",
+                partition_key=dynamodb.Attribute(name="listed", type=dynamodb.AttributeType.STRING),
+                sort_key=dynamodb.Attribute(name="created_at", type=dynamodb.AttributeType.STRING),
+                projection_type=dynamodb.ProjectionType.INCLUDE,
+                non_key_attributes=["object_name", "filename", "ready", "file_size"],
+            )
+
+        self.idempotency_table = dynamodb.Table(
+            self,
+            "once-idempotency-keys-table",
+            table_name="once-idempotency-keys",
+            partition_key=dynamodb.Attribute(name="idempotency_key", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=core.RemovalPolicy.DESTROY,
+        )
+
+        # Counters of the active shares, updated in the same transactions as the entries
+        self.stats_table = dynamodb.Table(
+            self,
+            "once-share-stats-table",
+            table_name="once-share-stats",
+            partition_key=dynamodb.Attribute(name="name", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=core.RemovalPolicy.DESTROY,
+        )
+
         self.api = apigw.HttpApi(self, "once-api", api_name="once-api")
 
         api_url = self.api.url
@@ -137,16 +179,28 @@ class OnceStack(core.Stack):
             code=make_python_zip_bundle(os.path.join(BASE_PATH, "get-upload-ticket")),
             handler="handler.on_event",
             log_retention=LOG_RETENTION,
+            # Presigning up to 1000 part URLs is CPU bound, and CPU is allocated along with memory.
+            # The timeout stays within the 30 seconds allowed to HTTP API integrations.
+            memory_size=1024,
+            timeout=core.Duration.seconds(29),
             environment={
                 "APP_URL": api_url,
+                "CONTENT_HASH_INDEX_NAME": "content-hash-index",
                 "FILES_TABLE_NAME": self.files_table.table_name,
                 "FILES_BUCKET": self.files_bucket.bucket_name,
+                "IDEMPOTENCY_TABLE_NAME": self.idempotency_table.table_name,
+                "INLINE_UPLOAD_MAX_SIZE": str(INLINE_UPLOAD_MAX_SIZE),
                 "SECRET_KEY": secret_key,
+                "STATS_TABLE_NAME": self.stats_table.table_name,
             },
         )
 
         self.files_bucket.grant_put(self.get_upload_ticket_function)
+        self.files_bucket.grant_read(self.get_upload_ticket_function)
+        self.files_bucket.grant_delete(self.get_upload_ticket_function)
         self.files_table.grant_read_write_data(self.get_upload_ticket_function)
+        self.idempotency_table.grant_read_write_data(self.get_upload_ticket_function)
+        self.stats_table.grant_read_write_data(self.get_upload_ticket_function)
 
         self.download_and_delete_function = lambda_.Function(
             self,
@@ -160,15 +214,43 @@ class OnceStack(core.Stack):
             environment={
                 "FILES_BUCKET": self.files_bucket.bucket_name,
                 "FILES_TABLE_NAME": self.files_table.table_name,
+                "STATS_TABLE_NAME": self.stats_table.table_name,
             },
         )
 
         self.files_bucket.grant_read(self.download_and_delete_function)
         self.files_bucket.grant_delete(self.download_and_delete_function)
         self.files_table.grant_read_write_data(self.download_and_delete_function)
+        self.stats_table.grant_read_write_data(self.download_and_delete_function)
+
+        self.mark_uploaded_files_function = lambda_.Function(
+            self,
+            "mark-uploaded-files-function",
+            function_name="once-mark-uploaded-files",
+            description="Marks entries as ready to be downloaded as soon as their file has been uploaded",
+            runtime=lambda_.Runtime.PYTHON_3_7,
+            code=lambda_.Code.from_asset(os.path.join(BASE_PATH, "mark-uploaded-files")),
+            handler="handler.on_event",
+            log_retention=LOG_RETENTION,
+            # Uploaded files are read back to verify their content hash
+            timeout=core.Duration.minutes(5),
+            environment={
+                "FILES_TABLE_NAME": self.files_table.table_name,
+                "STATS_TABLE_NAME": self.stats_table.table_name,
+            },
+        )
+
+        self.files_bucket.grant_read(self.mark_uploaded_files_function)
+        self.files_table.grant_read_write_data(self.mark_uploaded_files_function)
+        self.stats_table.grant_read_write_data(self.mark_uploaded_files_function)
+        self.files_bucket.add_event_notification(
+            s3.EventType.OBJECT_CREATED, s3n.LambdaDestination(self.mark_uploaded_files_function)
+        )
 
         get_upload_ticket_integration = integrations.LambdaProxyIntegration(handler=self.get_upload_ticket_function)
-        self.api.add_routes(path="/", methods=[apigw.HttpMethod.GET], integration=get_upload_ticket_integration)
+        self.api.add_routes(
+            path="/", methods=[apigw.HttpMethod.GET, apigw.HttpMethod.PUT], integration=get_upload_ticket_integration
+        )
 
         download_and_delete_integration = integrations.LambdaProxyIntegration(
             handler=self.download_and_delete_function
@@ -177,6 +259,30 @@ class OnceStack(core.Stack):
             path="/{entry_id}/{filename}", methods=[apigw.HttpMethod.GET], integration=download_and_delete_integration
         )
 
+        self.list_shares_function = lambda_.Function(
+            self,
+            "list-shares-function",
+            function_name="once-list-shares",
+            description="Lists the shared files waiting to be downloaded",
+            runtime=lambda_.Runtime.PYTHON_3_7,
+            code=lambda_.Code.from_asset(os.path.join(BASE_PATH, "list-shares")),
+            handler="handler.on_event",
+            log_retention=LOG_RETENTION,
+            environment={
+                "ACTIVE_SHARES_INDEX_NAME": "active-shares-index",
+                "FILES_TABLE_NAME": self.files_table.table_name,
+                "SECRET_KEY": secret_key,
+                "STATS_TABLE_NAME": self.stats_table.table_name,
+            },
+        )
+
+        self.files_table.grant_read_data(self.list_shares_function)
+        self.stats_table.grant_read_data(self.list_shares_function)
+
+        list_shares_integration = integrations.LambdaProxyIntegration(handler=self.list_shares_function)
+        self.api.add_routes(path="/shares", methods=[apigw.HttpMethod.GET], integration=list_shares_integration)
+        self.api.add_routes(path="/shares/stats", methods=[apigw.HttpMethod.GET], integration=list_shares_integration)
+
         self.cleanup_function = lambda_.Function(
             self,
             "delete-served-files-function",
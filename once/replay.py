@@ -0,0 +1,473 @@
+"""
+Replays HTTP API and S3 events against the lambda handlers in-process,
+profiling each invocation.
+
+AWS services are emulated with moto, which is a development dependency:
+
+    python -m once.replay --output-dir .profiles
+    python -m once.replay --corpus events.jsonl --mode cold --folded
+
+A corpus is a JSON lines file of `{"handler": ..., "event": ...}` objects, where events
+flagged with `"sign": true` get a fresh timestamp and signature before being replayed.
+Without a corpus, a synthetic one going through every handler is generated.
+
+In cold mode each invocation reloads the handler module and drops the default boto3 session,
+while libraries stay imported: `--import-time` measures their import in a fresh interpreter.
+Figures include the time spent by moto emulating the AWS APIs.
+"""
+
+import base64
+import cProfile
+import hashlib
+import hmac
+import importlib.util
+import json
+import os
+import pstats
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+from types import ModuleType
+from typing import Dict, Generator, List, Optional, Tuple
+from urllib.parse import quote_plus, urlencode
+
+import click
+
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+HANDLERS = [
+    "get-upload-ticket",
+    "mark-uploaded-files",
+    "list-shares",
+    "download-and-delete",
+    "delete-served-files",
+]
+
+APP_URL = "https://once.example.com/"
+FILES_BUCKET = "once-shared-files"
+FILES_TABLE_NAME = "once-files"
+IDEMPOTENCY_TABLE_NAME = "once-idempotency-keys"
+REGION_NAME = "eu-west-1"
+SECRET_KEY = base64.b64encode(b"once-replay-secret-key").decode("utf-8")
+SIGNATURE_HEADER = "x-once-signature"
+STATS_TABLE_NAME = "once-share-stats"
+IDEMPOTENCY_HEADER = "x-once-idempotency-key"
+TIMESTAMP_FORMAT = "%Y%m%d%H%M%S%f"
+
+HANDLER_ENVIRONMENT = {
+    "APP_URL": APP_URL,
+    "AWS_ACCESS_KEY_ID": "replay",
+    "AWS_SECRET_ACCESS_KEY": "replay",
+    "AWS_DEFAULT_REGION": REGION_NAME,
+    "FILES_BUCKET": FILES_BUCKET,
+    "FILES_TABLE_NAME": FILES_TABLE_NAME,
+    "IDEMPOTENCY_TABLE_NAME": IDEMPOTENCY_TABLE_NAME,
+    "S3_REGION_NAME": REGION_NAME,
+    "SECRET_KEY": SECRET_KEY,
+    "STATS_TABLE_NAME": STATS_TABLE_NAME,
+}
+
+
+class StackCollector:
+    """
+    A tracing profiler accumulating the time spent on each call stack,
+    written in the collapsed format read by flamegraph.pl and speedscope
+    """
+
+    def __init__(self):
+        self.stacks: Dict[Tuple[str, ...], float] = defaultdict(float)
+        self._stack: List[str] = []
+        self._last = None
+
+    def _account(self):
+        now = time.perf_counter()
+        if self._stack:
+            self.stacks[tuple(self._stack)] += now - self._last
+        self._last = now
+
+    def _profile(self, frame, event, arg):
+        if event in ("call", "c_call"):
+            self._account()
+            if event == "call":
+                code = frame.f_code
+                self._stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            else:
+                self._stack.append(f"{getattr(arg, '__qualname__', arg)} (builtin)")
+        elif event in ("return", "c_return", "c_exception") and self._stack:
+            self._account()
+            self._stack.pop()
+
+    def enable(self):
+        self._last = time.perf_counter()
+        sys.setprofile(self._profile)
+
+    def disable(self):
+        sys.setprofile(None)
+        self._stack = []
+
+    def dump(self, path: str):
+        with open(path, "w") as output:
+            for stack, seconds in sorted(self.stacks.items()):
+                output.write(f"{';'.join(stack)} {int(seconds * 1e6)}\n")
+
+
+def sign_event(event: Dict, secret_key: bytes) -> Dict:
+    """
+    Refreshes the timestamp of an event and signs it, the same way the client does
+    """
+    event["queryStringParameters"]["t"] = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+    qs = urlencode(event["queryStringParameters"], quote_via=quote_plus)
+    plain_text = f"{event['rawPath']}?{qs}"
+    if IDEMPOTENCY_HEADER in event["headers"]:
+        plain_text = f"{plain_text}\n{event['headers'][IDEMPOTENCY_HEADER]}"
+
+    hmac_obj = hmac.new(secret_key, msg=plain_text.encode("utf-8"), digestmod=hashlib.sha256)
+    event["headers"][SIGNATURE_HEADER] = base64.b64encode(hmac_obj.digest()).decode("utf-8")
+    return event
+
+
+def http_event(method: str, path: str, params: Dict, body: Optional[bytes] = None, **headers) -> Dict:
+    event = {
+        "version": "2.0",
+        "rawPath": path,
+        "queryStringParameters": params,
+        "headers": dict(headers, **{"user-agent": "once-replay"}),
+        "requestContext": {"http": {"method": method, "path": path}},
+    }
+    if body is not None:
+        event["body"] = base64.b64encode(body).decode("utf-8")
+        event["isBase64Encoded"] = True
+    return event
+
+
+def s3_event(object_name: str, size: int, etag: str) -> Dict:
+    return {
+        "Records": [
+            {
+                "eventSource": "aws:s3",
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "bucket": {"name": FILES_BUCKET},
+                    "object": {"key": quote_plus(object_name, safe="/"), "size": size, "eTag": etag},
+                },
+            }
+        ]
+    }
+
+
+def synthetic_corpus(count: int, payload_size: int) -> Generator[Dict, Optional[Dict], None]:
+    """
+    Generates the events of `count` shares, going through every handler.
+
+    The response of each invocation is sent back to the generator,
+    since later events refer to the entries created by earlier ones.
+    """
+    import boto3
+
+    s3 = boto3.client("s3")
+    for i in range(count):
+        payload = os.urandom(payload_size)
+        content_hash = hashlib.sha256(payload).hexdigest()
+        filename = f"artifact-{i}.bin"
+        params = {"f": quote_plus(filename), "t": "", "h": content_hash}
+
+        if i % 2:
+            response = yield {
+                "handler": "get-upload-ticket",
+                "event": http_event("PUT", "/", params, body=payload),
+                "sign": True,
+            }
+            entry_id = json.loads(response["body"])["once_url"].split("/")[-2]
+        else:
+            response = yield {
+                "handler": "get-upload-ticket",
+                "event": http_event("GET", "/", params, **{IDEMPOTENCY_HEADER: f"replay-{i:012d}"}),
+                "sign": True,
+            }
+            entry_id = json.loads(response["body"])["once_url"].split("/")[-2]
+
+            # Stands for the client upload, triggering the S3 notification
+            object_name = f"{entry_id}/{filename}"
+            # Notifications carry the ETag without the quotes returned by the S3 API
+            etag = s3.put_object(Bucket=FILES_BUCKET, Key=object_name, Body=payload)["ETag"].strip('"')
+            yield {"handler": "mark-uploaded-files", "event": s3_event(object_name, payload_size, etag)}
+
+        yield {"handler": "list-shares", "event": http_event("GET", "/shares", {"t": "", "l": "20"}), "sign": True}
+        yield {"handler": "list-shares", "event": http_event("GET", "/shares/stats", {"t": ""}), "sign": True}
+        yield {
+            "handler": "download-and-delete",
+            "event": dict(
+                http_event("GET", f"/{entry_id}/{filename}", {}),
+                pathParameters={"entry_id": entry_id, "filename": filename},
+            ),
+        }
+
+    yield {"handler": "delete-served-files", "event": {"source": "aws.events", "detail-type": "Scheduled Event"}}
+
+
+def recorded_corpus(path: str) -> Generator[Dict, Optional[Dict], None]:
+    with open(path) as corpus:
+        for line in corpus:
+            if line.strip():
+                yield json.loads(line)
+
+
+def create_resources():
+    """
+    Creates the bucket and the tables of the stack on the emulated services
+    """
+    import boto3
+
+    s3 = boto3.client("s3", region_name=REGION_NAME)
+    s3.create_bucket(Bucket=FILES_BUCKET, CreateBucketConfiguration={"LocationConstraint": REGION_NAME})
+
+    dynamodb = boto3.client("dynamodb", region_name=REGION_NAME)
+    dynamodb.create_table(
+        TableName=FILES_TABLE_NAME,
+        BillingMode="PAY_PER_REQUEST",
+        KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+        AttributeDefinitions=[
+            {"AttributeName": "id", "AttributeType": "S"},
+            {"AttributeName": "content_hash", "AttributeType": "S"},
+            {"AttributeName": "listed", "AttributeType": "S"},
+            {"AttributeName": "created_at", "AttributeType": "S"},
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                "IndexName": "content-hash-index",
+                "KeySchema": [{"AttributeName": "content_hash", "KeyType": "HASH"}],
+                "Projection": {"ProjectionType": "INCLUDE", "NonKeyAttributes": ["object_name", "etag", "deleted"]},
+            },
+            {
+                "IndexName": "active-shares-index",
+                "KeySchema": [
+                    {"AttributeName": "listed", "KeyType": "HASH"},
+                    {"AttributeName": "created_at", "KeyType": "RANGE"},
+                ],
+                "Projection": {
+                    "ProjectionType": "INCLUDE",
+                    "NonKeyAttributes": ["object_name", "filename", "ready", "file_size"],
+                },
+            },
+        ],
+    )
+    dynamodb.create_table(
+        TableName=IDEMPOTENCY_TABLE_NAME,
+        BillingMode="PAY_PER_REQUEST",
+        KeySchema=[{"AttributeName": "idempotency_key", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "idempotency_key", "AttributeType": "S"}],
+    )
+    dynamodb.create_table(
+        TableName=STATS_TABLE_NAME,
+        BillingMode="PAY_PER_REQUEST",
+        KeySchema=[{"AttributeName": "name", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "name", "AttributeType": "S"}],
+    )
+
+
+def load_handler(name: str) -> ModuleType:
+    """
+    Imports a fresh copy of a handler module, as a new container would do
+    """
+    spec = importlib.util.spec_from_file_location(
+        f"once_replay_{name.replace('-', '_')}", os.path.join(BASE_PATH, name, "handler.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def import_times(name: str) -> List[Dict]:
+    """
+    Measures the import time of a handler and its dependencies in a fresh interpreter
+    """
+    completed_process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import handler"],
+        cwd=os.path.join(BASE_PATH, name),
+        env=dict(os.environ, **HANDLER_ENVIRONMENT),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+
+    modules = []
+    for line in completed_process.stderr.decode("utf-8").splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:") :].split("|")
+        modules.append({"module": module.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us)})
+    return sorted(modules, key=lambda module: module["cumulative_us"], reverse=True)
+
+
+class Replayer:
+    """
+    Invokes the handlers with the events of a corpus, measuring each invocation
+    """
+
+    def __init__(self, cold: bool = False, folded: bool = False):
+        self.cold = cold
+        self.folded = folded
+        self.modules: Dict[str, ModuleType] = {}
+        self.profilers: Dict[str, object] = {}
+        self.invocations: List[Dict] = []
+
+    def _profiler(self, name: str):
+        if name not in self.profilers:
+            self.profilers[name] = StackCollector() if self.folded else cProfile.Profile()
+        return self.profilers[name]
+
+    def _init(self, name: str) -> float:
+        """
+        Loads the handler module when needed, returning the time it took
+        """
+        if not self.cold and name in self.modules:
+            return 0.0
+
+        import boto3
+
+        # Clients are built from the default session, which a new container doesn't have yet
+        boto3.DEFAULT_SESSION = None
+        started = time.perf_counter()
+        self.modules[name] = load_handler(name)
+        return time.perf_counter() - started
+
+    def invoke(self, name: str, event: Dict) -> Dict:
+        init_seconds = self._init(name)
+        handler = self.modules[name]
+        profiler = self._profiler(name)
+
+        tracemalloc.clear_traces()
+        allocated_before = tracemalloc.get_traced_memory()[0]
+        cpu_started = time.process_time()
+        wall_started = time.perf_counter()
+
+        profiler.enable()
+        try:
+            response = handler.on_event(event, None)
+        finally:
+            profiler.disable()
+
+        wall_seconds = time.perf_counter() - wall_started
+        cpu_seconds = time.process_time() - cpu_started
+        allocated_after, peak = tracemalloc.get_traced_memory()
+
+        status = response.get("statusCode") if isinstance(response, dict) else None
+        self.invocations.append(
+            {
+                "handler": name,
+                "invocation": len(self.invocations),
+                "cold": init_seconds > 0,
+                "status": status,
+                "init_seconds": init_seconds,
+                "wall_seconds": wall_seconds,
+                "cpu_seconds": cpu_seconds,
+                "allocated_bytes": allocated_after - allocated_before,
+                "peak_bytes": peak - allocated_before,
+            }
+        )
+        return response
+
+    def replay(self, corpus: Generator[Dict, Optional[Dict], None]):
+        secret_key = base64.b64decode(SECRET_KEY)
+        response = None
+        while True:
+            try:
+                item = corpus.send(response)
+            except StopIteration:
+                return
+
+            event = item["event"]
+            if item.get("sign"):
+                event = sign_event(event, secret_key)
+            response = self.invoke(item["handler"], event)
+
+    def dump(self, output_dir: str):
+        os.makedirs(output_dir, exist_ok=True)
+        for name, profiler in self.profilers.items():
+            if self.folded:
+                profiler.dump(os.path.join(output_dir, f"{name}.folded"))
+            else:
+                pstats.Stats(profiler).dump_stats(os.path.join(output_dir, f"{name}.prof"))
+
+        with open(os.path.join(output_dir, "invocations.jsonl"), "w") as output:
+            for invocation in self.invocations:
+                output.write(json.dumps(invocation) + "\n")
+
+    def summary(self) -> List[Dict]:
+        by_handler = defaultdict(list)
+        for invocation in self.invocations:
+            by_handler[invocation["handler"]].append(invocation)
+
+        summary = []
+        for name, invocations in by_handler.items():
+            cpu = sorted(invocation["cpu_seconds"] for invocation in invocations)
+            statuses = [invocation["status"] or 200 for invocation in invocations]
+            summary.append(
+                {
+                    "handler": name,
+                    "invocations": len(invocations),
+                    "cold_starts": sum(1 for invocation in invocations if invocation["cold"]),
+                    "init_seconds": sum(invocation["init_seconds"] for invocation in invocations),
+                    "cpu_seconds_p50": cpu[len(cpu) // 2],
+                    "cpu_seconds_max": cpu[-1],
+                    "peak_bytes_max": max(invocation["peak_bytes"] for invocation in invocations),
+                    "client_errors": sum(1 for status in statuses if 400 <= status < 500),
+                    "errors": sum(1 for status in statuses if status >= 500),
+                }
+            )
+        return summary
+
+
+@click.command("replay")
+@click.option("--corpus", "corpus_file", type=click.Path(exists=True, dir_okay=False), help="JSON lines corpus file.")
+@click.option("--count", default=20, help="Number of shares of the synthetic corpus.")
+@click.option("--payload-size", default=4096, help="Size in bytes of the files of the synthetic corpus.")
+@click.option("--mode", type=click.Choice(["warm", "cold"]), default="warm", help="Reuses or reloads the handlers.")
+@click.option("--folded", is_flag=True, default=False, help="Writes collapsed stacks instead of cProfile stats.")
+@click.option("--import-time", is_flag=True, default=False, help="Profiles the imports of each handler.")
+@click.option("--output-dir", default=".profiles", help="Folder where profiles are written.")
+def replay(
+    corpus_file: Optional[str],
+    count: int,
+    payload_size: int,
+    mode: str,
+    folded: bool,
+    import_time: bool,
+    output_dir: str,
+):
+    try:
+        from moto import mock_aws
+    except ImportError:
+        raise click.ClickException("moto is required to replay events, install the development dependencies")
+
+    os.environ.update(HANDLER_ENVIRONMENT)
+    replayer = Replayer(cold=mode == "cold", folded=folded)
+
+    with mock_aws():
+        create_resources()
+        corpus = recorded_corpus(corpus_file) if corpus_file else synthetic_corpus(count, payload_size)
+
+        tracemalloc.start()
+        try:
+            replayer.replay(corpus)
+        finally:
+            tracemalloc.stop()
+
+    replayer.dump(output_dir)
+    for handler_summary in replayer.summary():
+        click.echo(json.dumps(handler_summary))
+
+    if import_time:
+        for name in HANDLERS:
+            modules = import_times(name)
+            with open(os.path.join(output_dir, f"{name}.importtime.jsonl"), "w") as output:
+                for module in modules:
+                    output.write(json.dumps(module) + "\n")
+            click.echo(json.dumps({"handler": name, "slowest_imports": modules[:5]}))
+
+
+if __name__ == "__main__":
+    replay()